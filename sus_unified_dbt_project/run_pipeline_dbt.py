@@ -1,19 +1,22 @@
 ##################################################
 # Script to run dbt models/tests, query them in Snowflake, and then export the results to Excel
 ##################################################
-# Script runs from the sus_unified_dbt_project folder - set by 'project_dir' variable
+# Script runs from the sus_unified_dbt_project folder - set by 'DBT_PROJECT_DIR' variable
 ##################################################
 
 ## Set the number of days to report on in MAIN PIPELINE RUN SECTION at the end of this script ##
 
 import subprocess
+import threading
+import atexit
+from concurrent.futures import ThreadPoolExecutor
 import snowflake.connector
 import pandas as pd
-from openpyxl import Workbook
-from openpyxl.styles import PatternFill, Border, Side, Alignment
-from openpyxl.utils import get_column_letter
+import numpy as np
+import xlsxwriter
 from datetime import datetime
 import os
+import shutil
 import sys
 
 try:
@@ -22,48 +25,102 @@ try:
 except Exception:
     pass
 
+# Shared cell formats - added to the workbook once and reused for every cell (border 1 = thin)
+REPORT_FORMATS = {
+    "report_title": {"align": "left"},
+    "bordered": {"border": 1},
+    "date_hdr": {"border": 1, "align": "center"},
+    "weekend_hdr": {"bg_color": "#D9D9D9", "border": 1, "align": "center"},
+    "red_missing": {"bg_color": "#FFC7CE", "border": 1},
+    "green_ok": {"bg_color": "#C6EFCE", "border": 1},
+    "yellow_warn": {"bg_color": "#FFEB9C", "border": 1},
+    "orange_alert": {"bg_color": "#FFC000", "border": 1},
+}
+
+DBT_PROJECT_DIR = "c:/dev/dbt test/sus_unified_dbt_project"
+
+# Pipeline runs skip dbt telemetry, JSON artifact writes and the up-front relation cache,
+# and let dbt build independent models/tests in parallel
+DBT_GLOBAL_FLAGS = ["--no-send-anonymous-usage-stats", "--no-write-json", "--no-populate-cache"]
+DBT_THREADS = "4"
+
+# Optional: only test models changed since the last fully passing test run (state:modified+).
+# Off by default - the schema tests check each day's data, not just the model code
+DBT_TEST_MODIFIED_ONLY = os.environ.get("DBT_TEST_MODIFIED_ONLY", "").lower() in ("1", "true", "yes")
+DBT_STATE_DIR = "state"
+
 def run_dbt():
     print("Running dbt models...")
-    project_dir = "c:/dev/dbt test/sus_unified_dbt_project"
+    run_flags = DBT_GLOBAL_FLAGS
+    if DBT_TEST_MODIFIED_ONLY:
+        # Keep target/manifest.json - it becomes the comparison state for the next run
+        run_flags = [flag for flag in DBT_GLOBAL_FLAGS if flag != "--no-write-json"]
+
+    subprocess.run(["dbt", *run_flags, "run", "--threads", DBT_THREADS], check=True, cwd=DBT_PROJECT_DIR)
 
-    subprocess.run(["dbt", "run"], check=True, cwd=project_dir)
+    # Without a saved state (first run, or option off) the full test suite runs
+    test_cmd = ["dbt", *DBT_GLOBAL_FLAGS, "test", "--threads", DBT_THREADS]
+    if DBT_TEST_MODIFIED_ONLY and os.path.exists(os.path.join(DBT_PROJECT_DIR, DBT_STATE_DIR, "manifest.json")):
+        test_cmd += ["--select", "state:modified+", "--defer", "--state", DBT_STATE_DIR]
 
+    # The report only reads the models, so tests carry on in the background while it is queried and built
     print("Running dbt tests...")
-    try:
-        subprocess.run(["dbt", "test"], check=True, cwd=project_dir)
-    except subprocess.CalledProcessError:
+    return subprocess.Popen(test_cmd, cwd=DBT_PROJECT_DIR)
+
+def wait_for_dbt_test(dbt_test):
+    if dbt_test.wait() != 0:
         print("⚠️ dbt test failed, continuing with pipeline...")
+    elif DBT_TEST_MODIFIED_ONLY:
+        # Only move the state on once everything has passed, so failing models keep being tested
+        os.makedirs(os.path.join(DBT_PROJECT_DIR, DBT_STATE_DIR), exist_ok=True)
+        shutil.copy(os.path.join(DBT_PROJECT_DIR, "target", "manifest.json"),
+                    os.path.join(DBT_PROJECT_DIR, DBT_STATE_DIR, "manifest.json"))
+
+# Single Snowflake connection shared by every query (one SSO sign-in), closed on exit
+_CONN = None
+_CONN_LOCK = threading.Lock()
+
+def _get_conn():
+    global _CONN
+    with _CONN_LOCK:  # queries run on worker threads, so only the first caller connects
+        if _CONN is None:
+            _CONN = snowflake.connector.connect(
+                user=os.environ["SNOWFLAKE_USER"],
+                account=os.environ["SNOWFLAKE_ACCOUNT"],
+                warehouse=os.environ["SNOWFLAKE_WAREHOUSE"],
+                database=os.environ["SNOWFLAKE_DATABASE"],
+                schema=os.environ["SNOWFLAKE_SCHEMA"],
+                role=os.environ.get("SNOWFLAKE_ROLE"),
+                authenticator=os.environ.get("SNOWFLAKE_AUTHENTICATOR", "externalbrowser"),
+            )
+    return _CONN
+
+atexit.register(lambda: _CONN and _CONN.close())
+
+def warm_warehouse():
+    # Signs in and resumes the warehouse (if suspended) while dbt is still running,
+    # so the report queries start straight away
+    cur = _get_conn().cursor()
+    try:
+        cur.execute("ALTER WAREHOUSE IDENTIFIER(%s) RESUME IF SUSPENDED", (os.environ["SNOWFLAKE_WAREHOUSE"],))
+    except snowflake.connector.errors.ProgrammingError:
+        pass  # role can't operate the warehouse - the first report query resumes it instead
 
 def query_snowflake_activity(sql):
-    conn = snowflake.connector.connect(
-        user=os.environ["SNOWFLAKE_USER"],
-        account=os.environ["SNOWFLAKE_ACCOUNT"],
-        warehouse=os.environ["SNOWFLAKE_WAREHOUSE"],
-        database=os.environ["SNOWFLAKE_DATABASE"],
-        schema=os.environ["SNOWFLAKE_SCHEMA"],
-        role=os.environ.get("SNOWFLAKE_ROLE"),
-        authenticator=os.environ.get("SNOWFLAKE_AUTHENTICATOR", "externalbrowser"),
-    )
-    cur = conn.cursor()
+    cur = _get_conn().cursor()
     cur.execute(sql)
-    rows = cur.fetchall()
-    columns = [desc[0] for desc in cur.description]
-    df = pd.DataFrame(rows, columns=columns)
-    df["ACTIVITY_DATE"] = pd.to_datetime(df["ACTIVITY_DATE"])
-    df["DAY_LABEL"] = df["ACTIVITY_DATE"].dt.strftime("%d/%m/%Y")
+    df = cur.fetch_pandas_all()  # Arrow batches straight into a DataFrame, no Python row tuples
+    df["ACTIVITY_DATE"] = pd.to_datetime(df["ACTIVITY_DATE"], format="%Y-%m-%d")
+    # Date derivations done once here so the report builders are purely presentational.
+    # Labels are formatted per distinct date (rows share a small set of dates) and mapped back onto the rows
+    dates = df["ACTIVITY_DATE"].drop_duplicates()
+    df["DAY_LABEL"] = df["ACTIVITY_DATE"].map(dict(zip(dates, dates.dt.strftime("%d/%m/%Y"))))
+    df["WEEKDAY"] = df["ACTIVITY_DATE"].map(dict(zip(dates, dates.dt.day_name().str[:3])))  # Mon, Tue, ...
+    df["IS_WEEKEND"] = df["ACTIVITY_DATE"].dt.weekday >= 5  # Saturday/Sunday
     return df
 
 def query_snowflake_summary():
-    conn = snowflake.connector.connect(
-        user=os.environ["SNOWFLAKE_USER"],
-        account=os.environ["SNOWFLAKE_ACCOUNT"],
-        warehouse=os.environ["SNOWFLAKE_WAREHOUSE"],
-        database=os.environ["SNOWFLAKE_DATABASE"],
-        schema=os.environ["SNOWFLAKE_SCHEMA"],
-        role=os.environ.get("SNOWFLAKE_ROLE"),
-        authenticator=os.environ.get("SNOWFLAKE_AUTHENTICATOR", "externalbrowser"),
-    )
-    cur = conn.cursor()
+    cur = _get_conn().cursor()
     cur.execute("""
         SELECT 
             PROVIDER, 
@@ -74,204 +131,118 @@ def query_snowflake_summary():
             ACTION_REQUIRED
         FROM PROVIDER_MISSING_SUMMARY
     """)
-    rows = cur.fetchall()
-    columns = [desc[0] for desc in cur.description]
-    df = pd.DataFrame(rows, columns=columns)
+    df = cur.fetch_pandas_all()
     return df
 
-def build_summary_table(ws, df, title, start_row):
+def build_summary_table(ws, df, title, formats, row):
     # Title row
-    ws.cell(row=start_row, column=1, value=title).alignment = Alignment(horizontal="left")
+    ws.write(row, 0, title, formats["report_title"])
 
     # Header row
     headers = ["Provider", "APC Missing", "OP Missing", "ECDS Missing", "Total Missing", "Action Required"]
-    ws.append(headers)
-
-    # Data rows
-    for _, row in df.iterrows():
-        ws.append([
-            row["PROVIDER"], 
-            row["APC_MISSING_DAYS"], 
-            row["OP_MISSING_DAYS"],
-            row["ECDS_MISSING_DAYS"],
-            row["TOTAL_MISSING_SUBMISSIONS"], 
-            row["ACTION_REQUIRED"]
-        ])
-
-    # Formatting
-    red_fill = PatternFill(start_color="FFC7CE", end_color="FFC7CE", fill_type="solid")
-    green_fill = PatternFill(start_color="C6EFCE", end_color="C6EFCE", fill_type="solid")
-    thin_border = Border(left=Side(style="thin"), right=Side(style="thin"),
-                         top=Side(style="thin"), bottom=Side(style="thin"))
-
-    header_row = start_row + 1
-    first_data_row = header_row + 1
-    last_row = ws.max_row
-    last_col = 6  # Provider, APC, OP, ECDS, Total, Action
-
-    # Header borders
-    for cell in ws.iter_rows(min_row=header_row, max_row=header_row, min_col=1, max_col=last_col):
-        for c in cell:
-            c.border = thin_border
-
-    # Data borders + fills
-    for row in ws.iter_rows(min_row=first_data_row, max_row=last_row, min_col=1, max_col=last_col):
-        provider, apc, op, ecds, total, action = row
-        for c in row:
-            c.border = thin_border
-        
-        if int(total.value) > 0:
-            for c in row:
-                c.fill = red_fill
-        else:
-            for c in row:
-                c.fill = green_fill
-
-def build_pivot_table(ws, df, title, start_row):
-    df["ACTIVITY_DATE"] = pd.to_datetime(df["ACTIVITY_DATE"])
-    df["DAY_LABEL"] = df["ACTIVITY_DATE"].dt.strftime("%d/%m/%Y")
-    df["WEEKDAY"] = df["ACTIVITY_DATE"].dt.day_name().str[:3]  # Mon, Tue, ...
-
-    day_order = df[["ACTIVITY_DATE", "DAY_LABEL", "WEEKDAY"]].drop_duplicates().sort_values("ACTIVITY_DATE")
+    ws.write_row(row + 1, 0, headers, formats["bordered"])
+    row += 2
+
+    # Data rows - red if any submissions are missing, otherwise green
+    columns = ["PROVIDER", "APC_MISSING_DAYS", "OP_MISSING_DAYS", "ECDS_MISSING_DAYS",
+               "TOTAL_MISSING_SUBMISSIONS", "ACTION_REQUIRED"]
+    for provider, apc, op, ecds, total, action in df[columns].itertuples(index=False, name=None):
+        fmt = formats["red_missing"] if int(total) > 0 else formats["green_ok"]
+        ws.write_row(row, 0, [provider, apc, op, ecds, total, action], fmt)
+        row += 1
+
+    return row  # next free row
+
+def build_pivot_table(ws, df, title, formats, row):
+    day_order = df[["ACTIVITY_DATE", "DAY_LABEL", "WEEKDAY", "IS_WEEKEND"]].drop_duplicates().sort_values("ACTIVITY_DATE")
     day_labels_sorted = day_order["DAY_LABEL"].tolist()
     weekday_labels_sorted = day_order["WEEKDAY"].tolist()
+    weekend_mask = day_order["IS_WEEKEND"].to_numpy()  # one flag per day column
     providers = sorted(df["PROVIDER"].unique())
 
-    pivot_records = df.pivot(index="PROVIDER", columns="DAY_LABEL", values="RECORDS")
-    pivot_records = pivot_records.reindex(index=providers, columns=day_labels_sorted)
-
-    # Calculate weekday/weekend stats per provider
-    provider_stats = {}
-    for provider in providers:
-        provider_data = df[df["PROVIDER"] == provider]
-        weekday_data = provider_data[provider_data["ACTIVITY_DATE"].dt.weekday < 5]["RECORDS"]
-        weekend_data = provider_data[provider_data["ACTIVITY_DATE"].dt.weekday >= 5]["RECORDS"]
-
-        stats = {}
-        for label, series in [("weekday", weekday_data), ("weekend", weekend_data)]:
-            valid = series[series.notna() & (series > 0)]
-            if len(valid) > 2:
-                stats[label] = {"mean": valid.mean(), "std": valid.std()}
-            else:
-                stats[label] = None
-        provider_stats[provider] = stats
-
-    def map_status(val):
-        if pd.isna(val):
-            return "MISSING"
-        try:
-            return "MISSING" if float(val) == 0 else int(val)
-        except Exception:
-            return "MISSING"
-
-    pivot = pivot_records.map(map_status)
+    # Provider x day grid of record counts, filled in place (no row for a provider/day stays NaN)
+    provider_idx = pd.Categorical(df["PROVIDER"], categories=providers).codes
+    day_idx = pd.Categorical(df["DAY_LABEL"], categories=day_labels_sorted).codes
+    values = np.full((len(providers), len(day_labels_sorted)), np.nan)
+    values[provider_idx, day_idx] = df["RECORDS"].to_numpy(dtype=float)
+
+    # Calculate weekday/weekend stats per provider in a single groupby (missing/zero days excluded)
+    valid = df[df["RECORDS"].notna() & (df["RECORDS"] > 0)]
+    grouped_stats = valid.groupby(["PROVIDER", "IS_WEEKEND"])["RECORDS"].agg(["mean", "std", "count"])
+    grouped_stats = grouped_stats[grouped_stats["count"] > 2]  # too few days to judge otherwise
+    provider_stats = grouped_stats.unstack("IS_WEEKEND").reindex(
+        index=providers, columns=pd.MultiIndex.from_product([["mean", "std"], [False, True]]))
+
+    # Broadcast each provider's weekday/weekend mean and std across the day columns
+    mean_mat = np.where(weekend_mask, provider_stats[("mean", True)].to_numpy()[:, None],
+                        provider_stats[("mean", False)].to_numpy()[:, None])
+    std_mat = np.where(weekend_mask, provider_stats[("std", True)].to_numpy()[:, None],
+                       provider_stats[("std", False)].to_numpy()[:, None])
+
+    # Colour code per cell: 0 = missing, 1 = normal, 2 = over 2 std devs out, 3 = over 3 std devs out
+    with np.errstate(divide="ignore", invalid="ignore"):
+        z_scores = np.abs((values - mean_mat) / std_mat)
+    missing = np.isnan(values) | (values == 0)
+    has_stats = std_mat > 0
+    colour_codes = np.select(
+        [missing, has_stats & (z_scores > 3), has_stats & (z_scores > 2)],
+        [0, 3, 2], default=1)
+
+    # Displayed values - whole record counts, or MISSING where nothing (or zero) was submitted
+    counts = np.where(missing, 0, values).astype(np.int64).astype(object)
+    status = np.where(missing, "MISSING", counts)
+
+    code_formats = [formats["red_missing"], formats["green_ok"], formats["yellow_warn"], formats["orange_alert"]]  # indexed by colour code
 
     timestamp = datetime.now().strftime("dbt Pipeline run at %H:%M GMT, %d %b %Y")
-    ws.cell(row=start_row, column=1, value=timestamp).alignment = Alignment(horizontal="left")
-    ws.cell(row=start_row+1, column=1, value="")
-    ws.cell(row=start_row+2, column=1, value=title)
-
-    header_row = start_row+3
-
-    # Weekday row above date headers
-    ws.append([""] + weekday_labels_sorted)
-    for idx, cell in enumerate(ws[header_row], start=1):
-        cell.alignment = Alignment(horizontal="center")
-        if idx > 1:  # skip Provider column
-            activity_date = day_order.iloc[idx-2]["ACTIVITY_DATE"]
-            if activity_date.weekday() >= 5:  # Saturday/Sunday
-                cell.fill = PatternFill(start_color="D9D9D9", end_color="D9D9D9", fill_type="solid")
-                cell.border = Border(left=Side(style="medium"), right=Side(style="medium"),
-                                     top=Side(style="medium"), bottom=Side(style="medium"))
-
-    # Date header row
-    ws.append(["Provider"] + day_labels_sorted)
-    for idx, cell in enumerate(ws[header_row+1], start=1):
-        cell.alignment = Alignment(horizontal="center")
-        if idx > 1:
-            activity_date = day_order.iloc[idx-2]["ACTIVITY_DATE"]
-            if activity_date.weekday() >= 5:
-                cell.fill = PatternFill(start_color="D9D9D9", end_color="D9D9D9", fill_type="solid")
-                cell.border = Border(left=Side(style="medium"), right=Side(style="medium"),
-                                     top=Side(style="medium"), bottom=Side(style="medium"))
-
-    # Data rows
-    for provider, row in pivot.iterrows():
-        ws.append([provider] + list(row.values))
-
-    # Formatting
-    red_fill = PatternFill(start_color="FFC7CE", end_color="FFC7CE", fill_type="solid")
-    green_fill = PatternFill(start_color="C6EFCE", end_color="C6EFCE", fill_type="solid")
-    yellow_fill = PatternFill(start_color="FFEB9C", end_color="FFEB9C", fill_type="solid")
-    orange_fill = PatternFill(start_color="FFC000", end_color="FFC000", fill_type="solid")
-    thin_border = Border(left=Side(style="thin"), right=Side(style="thin"),
-                         top=Side(style="thin"), bottom=Side(style="thin"))
-
-    first_data_row = header_row+2
-    last_row = ws.max_row
-    last_col = len(pivot.columns) + 1
-
-    # Borders for headers
-    for row in ws.iter_rows(min_row=header_row, max_row=header_row+1, min_col=1, max_col=last_col):
-        for c in row:
-            c.border = thin_border
+    ws.write(row, 0, timestamp, formats["report_title"])
+    ws.write(row + 2, 0, title)
+    row += 3
+
+    # Weekday row above date headers, then the date header row - weekend columns shaded
+    for first_label, labels in [("", weekday_labels_sorted), ("Provider", day_labels_sorted)]:
+        ws.write(row, 0, first_label, formats["date_hdr"])
+        for col, (label, is_weekend) in enumerate(zip(labels, weekend_mask), start=1):
+            ws.write(row, col, label, formats["weekend_hdr" if is_weekend else "date_hdr"])
+        row += 1
 
     # Data rows with weekend-aware anomaly detection
-    for row_idx, row in enumerate(ws.iter_rows(min_row=first_data_row, max_row=last_row, min_col=1, max_col=last_col)):
-        provider_name = providers[row_idx]
-        for j, c in enumerate(row, start=1):
-            c.border = thin_border
-            if j == 1:  # Provider column
-                continue
-            if c.value == "MISSING":
-                c.fill = red_fill
-            elif isinstance(c.value, (int, float)):
-                # Determine if this column is weekend or weekday
-                activity_date = day_order.iloc[j-2]["ACTIVITY_DATE"]
-                is_weekend = activity_date.weekday() >= 5
-                stats = provider_stats[provider_name]["weekend" if is_weekend else "weekday"]
-
-                if stats and stats["std"] > 0:
-                    z_score = abs((float(c.value) - stats["mean"]) / stats["std"])
-                    if z_score > 3:
-                        c.fill = orange_fill
-                    elif z_score > 2:
-                        c.fill = yellow_fill
-                    else:
-                        c.fill = green_fill
-                else:
-                    c.fill = green_fill
-            else:
-                c.fill = green_fill
-
-    # Column widths
-    ws.column_dimensions["A"].width = 35
-    for i in range(2, last_col+1):
-        ws.column_dimensions[get_column_letter(i)].width = 11.36
+    # (.tolist() converts each grid to plain Python lists once, rather than indexing the arrays per cell)
+    for provider_name, row_values, row_codes in zip(providers, status.tolist(), colour_codes.tolist()):
+        ws.write(row, 0, provider_name, formats["bordered"])  # Provider column
+        for col, (value, code) in enumerate(zip(row_values, row_codes), start=1):
+            ws.write(row, col, value, code_formats[code])
+        row += 1
+
+    return row  # next free row
 
 
 def export_to_excel(df_summary, df_inpatient, df_op, df_ecds, filename="provider_status.xlsx"):
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Provider Daily Status"
+    # constant_memory streams each row to disk as soon as the next one starts, so the sheet
+    # is written strictly top to bottom: summary first, then each pivot block in turn
+    wb = xlsxwriter.Workbook(filename, {"constant_memory": True})
+    ws = wb.add_worksheet("Provider Daily Status")
+    formats = {name: wb.add_format(properties) for name, properties in REPORT_FORMATS.items()}
 
     # Summary block
-    build_summary_table(ws, df_summary, "Provider Missing Days Summary (Rolling 20 Day Monitoring Window)", start_row=1)
-
-    # Spacer
-    ws.append([]); ws.append([])
-
-    # Inpatient block
-    build_pivot_table(ws, df_inpatient, "Inpatient Provider Daily Status", start_row=ws.max_row+1)
-
-    # Outpatient block
-    build_pivot_table(ws, df_op, "Outpatient Provider Daily Status", start_row=ws.max_row+3)
-
-    # ECDS block
-    build_pivot_table(ws, df_ecds, "Emergency Attendances (ECDS) Daily Status", start_row=ws.max_row+3)
-
-    ws.freeze_panes = ws["B2"] # Freeze top row and first column
-    wb.save(filename)
+    row = build_summary_table(ws, df_summary, "Provider Missing Days Summary (Rolling 20 Day Monitoring Window)", formats, row=0)
+
+    # Inpatient, Outpatient and ECDS blocks, separated by spacer rows
+    pivot_blocks = [
+        (df_inpatient, "Inpatient Provider Daily Status"),
+        (df_op, "Outpatient Provider Daily Status"),
+        (df_ecds, "Emergency Attendances (ECDS) Daily Status"),
+    ]
+    for df, title in pivot_blocks:
+        row = build_pivot_table(ws, df, title, formats, row=row + 2)
+
+    # Column widths - Provider column, then one column per day (at least as wide as the summary table)
+    last_col = max([6] + [df["ACTIVITY_DATE"].nunique() + 1 for df, _ in pivot_blocks])
+    ws.set_column(0, 0, 35)
+    ws.set_column(1, last_col - 1, 11.36)
+    ws.freeze_panes(1, 1) # Freeze top row and first column
+
+    wb.close()
     print(f"Excel report saved as {filename}")
     return filename
 
@@ -282,33 +253,51 @@ def open_excel(filename):
         pass
 
 if __name__ == "__main__":
-    run_dbt()
-    df_summary   = query_snowflake_summary()
-    df_inpatient = query_snowflake_activity("""
-    SELECT PROVIDER, ACTIVITY_DATE, RECORDS
+    pool = ThreadPoolExecutor(max_workers=2)
+    warm_warehouse_future = pool.submit(warm_warehouse)
+    dbt_test = None
+    try:
+        dbt_test = run_dbt()  # returns once dbt run is done, with dbt test still running
+        warm_warehouse_future.result()
+
+        # The queries are I/O bound, so run them concurrently (each on its own cursor of the shared connection).
+        # All three activity tables come back in one UNION ALL round trip, tagged by SOURCE
+        summary_future = pool.submit(query_snowflake_summary)
+        activity_future = pool.submit(query_snowflake_activity, """
+    SELECT 'APC' AS SOURCE, PROVIDER, ACTIVITY_DATE, RECORDS
     FROM PROVIDER_DAILY_APC_ACTIVITY_DBT
     WHERE ACTIVITY_DATE >= CURRENT_DATE - INTERVAL '34 days'
     AND ACTIVITY_DATE < CURRENT_DATE - INTERVAL '14 days'
-""")
-
-df_op = query_snowflake_activity("""
-    SELECT PROVIDER, ACTIVITY_DATE, RECORDS
+    UNION ALL
+    SELECT 'OP' AS SOURCE, PROVIDER, ACTIVITY_DATE, RECORDS
     FROM PROVIDER_DAILY_OP_ACTIVITY_DBT
     WHERE ACTIVITY_DATE >= CURRENT_DATE - INTERVAL '34 days'
     AND ACTIVITY_DATE < CURRENT_DATE - INTERVAL '14 days'
-""")
-
-df_ecds = query_snowflake_activity("""
-    SELECT PROVIDER, ACTIVITY_DATE, RECORDS
+    UNION ALL
+    SELECT 'ECDS' AS SOURCE, PROVIDER, ACTIVITY_DATE, RECORDS
     FROM PROVIDER_DAILY_ECDS_ACTIVITY_DBT
     WHERE ACTIVITY_DATE >= CURRENT_DATE - INTERVAL '34 days'
     AND ACTIVITY_DATE < CURRENT_DATE - INTERVAL '14 days'
 """)
+        df_summary  = summary_future.result()
+        df_activity = activity_future.result()
+
+        # Split back out per dataset (a dataset with no rows comes back as an empty frame)
+        df_inpatient, df_op, df_ecds = [
+            df_activity[df_activity["SOURCE"] == source].drop(columns="SOURCE").reset_index(drop=True)
+            for source in ["APC", "OP", "ECDS"]
+        ]
+
+        if df_summary.empty or df_inpatient.empty or df_op.empty or df_ecds.empty:
+            print("One or more datasets are empty. Please check dbt models and Snowflake sources.")
+            sys.exit(0)
+
+        filename = export_to_excel(df_summary, df_inpatient, df_op, df_ecds)
+        open_excel(filename)
+    finally:
+        # dbt test always runs to completion (its on-run-end hook logs the results), even if the report failed
+        if dbt_test is not None:
+            wait_for_dbt_test(dbt_test)
+        pool.shutdown()
 
-    if df_summary.empty or df_inpatient.empty or df_op.empty or df_ecds.empty:
-        print("One or more datasets are empty. Please check dbt models and Snowflake sources.")
-        sys.exit(0)
-
-    filename = export_to_excel(df_summary, df_inpatient, df_op, df_ecds)
-    open_excel(filename)
     print("dbt Project Pipeline completed successfully!")
\ No newline at end of file